@@ -1,22 +1,42 @@
 import os
+import re
+import asyncio
+import base64
+import hmac
 import random
 import hashlib
+import itertools
+import logging
 import secrets
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+import sqlite3
+import string
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+import httpx
 import jwt
-import google.generativeai as genai
+import orjson
 
 from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 # =====================================================
 # ENV
 # =====================================================
 JWT_SECRET = os.getenv("JWT_SECRET", "CHANGE_ME_SECRET")
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "FahadJassar14061436")
+ADMIN_TOKEN_BYTES = ADMIN_TOKEN.encode()
+# مفتاح هاش أكواد التفعيل (BLAKE2b يقبل مفتاحاً حتى 64 بايت)
+CODE_HASH_KEY = os.getenv("CODE_HASH_KEY", JWT_SECRET).encode()[:64]
 
 GEMINI_KEYS = [
     os.getenv("GEMINI_API_KEY_1"),
@@ -32,10 +52,44 @@ GEMINI_KEYS = [k for k in GEMINI_KEYS if k]
 if not GEMINI_KEYS:
     raise RuntimeError("No Gemini API Keys found")
 
+GEMINI_MODEL = "gemini-2.5-flash-lite"
+GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse"
+
+# مهلة قصيرة للاتصال حتى يُكتشف المفتاح/المسار المعطل بسرعة، وطويلة لقراءة التوليد
+GEMINI_TIMEOUT = httpx.Timeout(float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60")), connect=5.0)
+
 # =====================================================
 # APP
 # =====================================================
-app = FastAPI(title="Nassr AI Backend - تقارير تعليمية")
+# عميل HTTP غير متزامن واحد مشترك لكل طلبات Gemini
+GEMINI_CLIENT: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global GEMINI_CLIENT
+    GEMINI_CLIENT = httpx.AsyncClient(
+        timeout=GEMINI_TIMEOUT,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+    )
+    # Redis يحذف المنتهي بنفسه عبر TTL فلا حاجة لدورة تنظيف
+    cleanup_task = asyncio.create_task(cleanup_loop()) if CODES_REDIS is None else None
+    yield
+    if cleanup_task is not None:
+        cleanup_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await cleanup_task
+    # مهام التقارير الجارية تُلغى وتُسجَّل فاشلة قبل إغلاق عميل Gemini الذي تستخدمه
+    for task in REPORT_JOB_TASKS:
+        task.cancel()
+    await asyncio.gather(*REPORT_JOB_TASKS, return_exceptions=True)
+    await GEMINI_CLIENT.aclose()
+
+app = FastAPI(
+    title="Nassr AI Backend - تقارير تعليمية",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -64,10 +118,133 @@ class ReportGenerateRequest(BaseModel):
     count: Optional[str] = ""
 
 # =====================================================
-# STORAGE (مؤقت - in memory)
+# STORAGE (Redis إن وُجد REDIS_URL، وإلا SQLite WAL)
 # =====================================================
-# code_hash -> expires_at
-VALID_CODES = {}
+# كلا الخيارين مشترك بين كل عمليات uvicorn؛ Redis يشاركه أيضاً بين الخوادم
+REDIS_URL = os.getenv("REDIS_URL")
+CODES_DB_PATH = os.getenv("CODES_DB_PATH", "activation_codes.db")
+
+if REDIS_URL:
+    import redis
+
+    # المفتاح code:<hash> وقيمته "<duration>|<expires_ts>"، وRedis يحذفه عند انتهاء TTL
+    CODES_REDIS = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    CODES_DB = None
+else:
+    CODES_REDIS = None
+    CODES_DB = sqlite3.connect(CODES_DB_PATH, check_same_thread=False, isolation_level=None)
+    CODES_DB.execute("PRAGMA journal_mode=WAL")
+    CODES_DB.execute("PRAGMA synchronous=NORMAL")
+    CODES_DB.execute(
+        "CREATE TABLE IF NOT EXISTS codes ("
+        "code_hash TEXT PRIMARY KEY, "
+        "expires_ts REAL NOT NULL, "
+        "duration TEXT NOT NULL)"
+    )
+    CODES_DB.execute("CREATE INDEX IF NOT EXISTS idx_codes_expires_ts ON codes (expires_ts)")
+    CODES_DB.execute(
+        "CREATE TABLE IF NOT EXISTS report_jobs ("
+        "job_id TEXT PRIMARY KEY, "
+        "job TEXT NOT NULL, "
+        "expires_ts REAL NOT NULL)"
+    )
+    CODES_DB.execute("CREATE INDEX IF NOT EXISTS idx_report_jobs_expires_ts ON report_jobs (expires_ts)")
+
+# اتصال SQLite مشترك بين خيوط FastAPI
+CODES_DB_LOCK = threading.Lock()
+
+def save_codes(code_hashes: List[str], expires_ts: float, duration: str) -> List[str]:
+    """حفظ الأكواد الجديدة فقط؛ يعيد هاشات الأكواد الموجودة مسبقاً بدل الكتابة فوقها"""
+    if CODES_REDIS is not None:
+        # TTL من المدة نفسها بدل قراءة الساعة مرة ثانية
+        ttl = int(DURATION_SECONDS[duration]) + 1
+        value = f"{duration}|{expires_ts}"
+        # دفعة الأكواد كلها في رحلة واحدة إلى Redis؛ NX لا يغير صلاحية كود لمستخدم آخر
+        pipe = CODES_REDIS.pipeline(transaction=False)
+        for code_hash in code_hashes:
+            pipe.set(f"code:{code_hash}", value, ex=ttl, nx=True)
+        saved = pipe.execute()
+        return [code_hash for code_hash, ok in zip(code_hashes, saved) if not ok]
+    taken = []
+    with CODES_DB_LOCK:
+        # معاملة واحدة للدفعة كلها
+        CODES_DB.execute("BEGIN")
+        try:
+            for code_hash in code_hashes:
+                cursor = CODES_DB.execute(
+                    "INSERT OR IGNORE INTO codes (code_hash, expires_ts, duration) VALUES (?, ?, ?)",
+                    (code_hash, expires_ts, duration),
+                )
+                if cursor.rowcount == 0:
+                    taken.append(code_hash)
+            CODES_DB.execute("COMMIT")
+        except BaseException:
+            CODES_DB.execute("ROLLBACK")
+            raise
+    return taken
+
+def get_code_expiry(code_hash: str) -> Optional[float]:
+    if CODES_REDIS is not None:
+        value = CODES_REDIS.get(f"code:{code_hash}")
+        return float(value.rpartition("|")[2]) if value else None
+    with CODES_DB_LOCK:
+        row = CODES_DB.execute(
+            "SELECT expires_ts FROM codes WHERE code_hash = ?", (code_hash,)
+        ).fetchone()
+    return row[0] if row else None
+
+def delete_code(code_hash: str):
+    if CODES_REDIS is not None:
+        CODES_REDIS.delete(f"code:{code_hash}")
+        return
+    with CODES_DB_LOCK:
+        CODES_DB.execute("DELETE FROM codes WHERE code_hash = ?", (code_hash,))
+
+# حذف الأكواد المنتهية في الخلفية مرة كل دقيقة بدل داخل طلبات الأدمن
+CLEANUP_INTERVAL_SECONDS = 60
+
+def cleanup_expired_codes(now: float):
+    # Redis يحذف المفاتيح المنتهية بنفسه عبر TTL
+    if CODES_REDIS is not None:
+        return
+    # الحذف يمر على فهرس expires_ts فيلمس المنتهية فقط
+    with CODES_DB_LOCK:
+        CODES_DB.execute("DELETE FROM codes WHERE expires_ts < ?", (now,))
+        CODES_DB.execute("DELETE FROM report_jobs WHERE expires_ts < ?", (now,))
+
+async def cleanup_loop():
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(cleanup_expired_codes, time.time())
+        except Exception:
+            # فشل دورة واحدة لا يوقف التنظيف؛ الدورة التالية تعيد المحاولة
+            logger.exception("Expired code cleanup failed")
+
+# نتائج مهام توليد التقارير تبقى ساعة ثم تُحذف
+REPORT_JOB_TTL_SECONDS = 3600
+
+def save_report_job(job_id: str, job: Dict):
+    value = orjson.dumps(job)
+    if CODES_REDIS is not None:
+        CODES_REDIS.set(f"job:{job_id}", value, ex=REPORT_JOB_TTL_SECONDS)
+        return
+    with CODES_DB_LOCK:
+        CODES_DB.execute(
+            "INSERT OR REPLACE INTO report_jobs (job_id, job, expires_ts) VALUES (?, ?, ?)",
+            (job_id, value.decode(), time.time() + REPORT_JOB_TTL_SECONDS),
+        )
+
+def get_report_job(job_id: str) -> Optional[Dict]:
+    if CODES_REDIS is not None:
+        value = CODES_REDIS.get(f"job:{job_id}")
+        return orjson.loads(value) if value else None
+    with CODES_DB_LOCK:
+        row = CODES_DB.execute(
+            "SELECT job FROM report_jobs WHERE job_id = ? AND expires_ts >= ?",
+            (job_id, time.time()),
+        ).fetchone()
+    return orjson.loads(row[0]) if row else None
 
 # =====================================================
 # أنواع التقارير (من الفرونت إند)
@@ -368,36 +545,361 @@ EDUCATION_ADMINISTRATIONS = [
     "الإدارة العامة للتعليم بمحافظة جدة"
 ]
 
+# =====================================================
+# ترقيم حقول استجابة الذكاء الاصطناعي
+# =====================================================
+FIELD_BY_DIGIT = {
+    "1": "goal", "١": "goal",
+    "2": "summary", "٢": "summary",
+    "3": "steps", "٣": "steps",
+    "4": "strategies", "٤": "strategies",
+    "5": "strengths", "٥": "strengths",
+    "6": "improve", "٦": "improve",
+    "7": "recomm", "٧": "recomm",
+}
+
+# رقم الحقل ثم نقطة ثم المحتوى؛ البنود المرقمة بـ "1-" أو "1)" داخل الحقل ليست عناوين حقول
+FIELD_HEADER_RE = re.compile(r"^([1-7١-٧])\.\s*(.*)$")
+
+FIELD_DIGITS = frozenset("1234567١٢٣٤٥٦٧")
+
+class ReportFieldParser:
+    """يحلل رد الذكاء الاصطناعي سطراً بسطر ويُرجع الحقل عند اكتماله (يصلح للبث)"""
+
+    def __init__(self):
+        self.key: Optional[str] = None
+        self.lines: List[str] = []
+
+    def feed(self, line: str) -> Optional[Tuple[str, str]]:
+        line = line.strip()
+        if not line:
+            return None
+        
+        # فحص الحرف الأول بـ frozenset أولاً؛ التعبير النمطي لا يعمل إلا على السطور التي تبدأ برقم حقل
+        if line[0] in FIELD_DIGITS:
+            # بداية حقل جديد تعني اكتمال الحقل السابق
+            header = FIELD_HEADER_RE.match(line)
+            if header:
+                done = self.close()
+                self.key = FIELD_BY_DIGIT[header.group(1)]
+                self.lines = [header.group(2)]
+                return done
+            return None
+        
+        if self.key is not None:
+            self.lines.append(line)
+        return None
+
+    def close(self) -> Optional[Tuple[str, str]]:
+        if self.key is None:
+            return None
+        field = (self.key, ' '.join(self.lines).strip())
+        self.key = None
+        self.lines = []
+        return field
+
 # =====================================================
 # HELPERS
 # =====================================================
-def pick_gemini_model():
-    key = random.choice(GEMINI_KEYS)
-    genai.configure(api_key=key)
-    return genai.GenerativeModel("models/gemini-2.5-flash-lite")
+class LRUCache:
+    """قاموس محدود الحجم يطرد الأقدم استخداماً؛ القفل يحميه عند الوصول من خيوط FastAPI"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
 
-def generate_short_code():
-    return secrets.token_hex(3).upper()
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+# تدوير المفاتيح بالتناوب لتوزيع الحمل بالتساوي على حصص Gemini
+GEMINI_KEY_COUNTER = itertools.count()
+
+# ترويسة كل مفتاح تُبنى مرة واحدة عند التحميل
+GEMINI_KEY_HEADERS = [{"x-goog-api-key": key} for key in GEMINI_KEYS]
+
+def pick_gemini_headers():
+    return GEMINI_KEY_HEADERS[next(GEMINI_KEY_COUNTER) % len(GEMINI_KEY_HEADERS)]
+
+# عدد المفاتيح التي نجربها قبل إرجاع الخطأ
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_RETRY_BASE_DELAY = 0.5
+
+def gemini_retry_delay(attempt: int) -> float:
+    # لا انتظار ما دام هناك مفتاح لم يُجرَّب؛ بعدها تراجع أسي مع عشوائية
+    if attempt + 1 < len(GEMINI_KEYS):
+        return 0.0
+    return GEMINI_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+def is_retryable_gemini_error(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+async def gemini_send(url: str, prompt: str, stream: bool = False) -> httpx.Response:
+    """إرسال البرومت إلى Gemini مع الانتقال لمفتاح آخر عند 429/5xx؛ يعيد الرد بعد التحقق من حالته"""
+    last_error: Optional[Exception] = None
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        request = GEMINI_CLIENT.build_request(
+            "POST",
+            url,
+            json={"contents": [{"parts": [{"text": prompt}]}]},
+            headers=pick_gemini_headers(),
+        )
+        response: Optional[httpx.Response] = None
+        try:
+            response = await GEMINI_CLIENT.send(request, stream=stream)
+            response.raise_for_status()
+        except Exception as e:
+            # رد البث المفتوح يُغلق حتى يعود اتصاله إلى المجمع
+            if stream and response is not None:
+                await response.aclose()
+            if not is_retryable_gemini_error(e):
+                raise
+            last_error = e
+            if attempt + 1 < GEMINI_MAX_ATTEMPTS:
+                delay = gemini_retry_delay(attempt)
+                if delay:
+                    await asyncio.sleep(delay)
+            continue
+        return response
+    raise last_error
+
+async def gemini_request(prompt: str) -> str:
+    """استدعاء Gemini عبر REST بدون حجز خيط أثناء انتظار الرد"""
+    response = await gemini_send(GEMINI_URL, prompt)
+    parts = response.json()["candidates"][0]["content"]["parts"]
+    return "".join(part.get("text", "") for part in parts)
+
+# digest البرومت -> استدعاء Gemini الجاري له
+GEMINI_INFLIGHT: Dict[bytes, "asyncio.Future[str]"] = {}
+
+async def gemini_generate(prompt: str) -> str:
+    """الطلبات المتزامنة بنفس البرومت تنتظر استدعاء Gemini واحداً بدل استدعاء لكل طلب"""
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    call = GEMINI_INFLIGHT.get(key)
+    if call is None:
+        call = asyncio.ensure_future(gemini_request(prompt))
+        GEMINI_INFLIGHT[key] = call
+        
+        def forget(done: "asyncio.Future[str]"):
+            GEMINI_INFLIGHT.pop(key, None)
+            # قراءة الخطأ حتى لا يُسجَّل كخطأ غير مقروء إذا انسحب كل المنتظرين
+            if not done.cancelled():
+                done.exception()
+        
+        call.add_done_callback(forget)
+    # انسحاب أحد العملاء لا يلغي الاستدعاء على البقية
+    return await asyncio.shield(call)
+
+# digest البرومت -> (وقت الانتهاء، نص الرد) للتقارير فقط: المعلم الذي يكرر نفس التقرير
+# خلال المدة يحصل على الرد نفسه؛ /generate و/consult/educational يبقيان بتوليد جديد دائماً.
+# "إعادة التوليد" ترسل Cache-Control: no-cache، وno-store لا يقرأ ولا يحفظ؛ 0 يعطل الكاش
+REPORT_CACHE_TTL_SECONDS = int(os.getenv("REPORT_CACHE_TTL_SECONDS", "1800"))
+REPORT_RESPONSES = LRUCache(maxsize=2048)
+
+def report_cache_policy(cache_control: Optional[str]) -> Tuple[bool, bool]:
+    """(القراءة من الكاش، الحفظ فيه) حسب ترويسة Cache-Control في الطلب"""
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    return not directives & {"no-cache", "no-store"}, "no-store" not in directives
+
+async def gemini_generate_report(prompt: str, read_cache: bool = True, store_cache: bool = True) -> str:
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    if read_cache:
+        cached = REPORT_RESPONSES.get(key)
+        if cached is not None:
+            if cached[0] > time.time():
+                return cached[1]
+            REPORT_RESPONSES.pop(key)
+    
+    text = await gemini_generate(prompt)
+    if store_cache and REPORT_CACHE_TTL_SECONDS > 0:
+        REPORT_RESPONSES.put(key, (time.time() + REPORT_CACHE_TTL_SECONDS, text))
+    return text
+
+async def open_gemini_stream(prompt: str) -> httpx.Response:
+    """فتح بث Gemini (SSE) والتحقق من حالته قبل إرسال أي ترويسة للعميل"""
+    return await gemini_send(GEMINI_STREAM_URL, prompt, stream=True)
+
+async def gemini_stream(response: httpx.Response) -> AsyncIterator[str]:
+    """بث نص Gemini قطعة بقطعة بدل انتظار الرد كاملاً؛ يغلق الرد عند الانتهاء"""
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = orjson.loads(line[5:])
+            for candidate in chunk.get("candidates", [])[:1]:
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
+    finally:
+        await response.aclose()
+
+# 32 رمزاً بدون الرموز الملتبسة (I, O, 0, 1) - كل خانة 5 بت، والكود 8 خانات = 40 بت
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+CODE_LENGTH = 8
+CODE_BYTES = 5
+
+# تطبيع الكود المُدخل في مرور واحد: حذف المسافات وتحويل الأحرف الصغيرة إلى كبيرة
+CODE_NORMALIZE_TABLE = str.maketrans(string.ascii_lowercase, string.ascii_uppercase, string.whitespace)
+
+# شكل كود التفعيل كما يولده generate_short_codes (8 خانات، والأكواد القديمة 6 خانات حتى تنتهي)
+ACTIVATION_CODE_RE = re.compile(r"[A-HJ-NP-Z2-9]{6}(?:[A-HJ-NP-Z2-9]{2})?")
+
+# الحد الأقصى لعدد الأكواد في طلب إصدار واحد
+MAX_CODES_PER_REQUEST = 500
+
+# مخزون بايتات عشوائية يُملأ بقراءة 4KB واحدة ويُستهلك 5 بايت لكل كود
+CODE_RANDOM_POOL_SIZE = 4096
+CODE_RANDOM_POOL = bytearray()
+CODE_RANDOM_LOCK = threading.Lock()
+
+def take_random_bytes(n: int) -> bytes:
+    with CODE_RANDOM_LOCK:
+        if len(CODE_RANDOM_POOL) < n:
+            CODE_RANDOM_POOL.extend(secrets.token_bytes(max(n, CODE_RANDOM_POOL_SIZE)))
+        chunk = bytes(CODE_RANDOM_POOL[:n])
+        # البايتات المستخدمة تُحذف فلا يتكرر أي كود من نفس المخزون
+        del CODE_RANDOM_POOL[:n]
+    return chunk
+
+def generate_short_codes(count: int) -> List[str]:
+    # dict يحفظ الترتيب ويُسقط التكرار داخل الدفعة نفسها
+    codes: Dict[str, None] = {}
+    while len(codes) < count:
+        needed = count - len(codes)
+        buf = take_random_bytes(CODE_BYTES * needed)
+        for offset in range(0, CODE_BYTES * needed, CODE_BYTES):
+            bits = int.from_bytes(buf[offset:offset + CODE_BYTES], "big")
+            codes["".join(CODE_ALPHABET[(bits >> (5 * i)) & 31] for i in range(CODE_LENGTH))] = None
+    return list(codes)
+
+def utc_iso(ts: float) -> str:
+    # بديل utcfromtimestamp (مهمل منذ Python 3.12) بنفس الصيغة بدون +00:00
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+# نص الوقت الحالي يُعاد استخدامه داخل نفس الثانية
+_UTC_ISO_CACHE = {"second": -1, "iso": ""}
+
+def cached_utc_iso():
+    second = int(time.time())
+    if second != _UTC_ISO_CACHE["second"]:
+        _UTC_ISO_CACHE["iso"] = utc_iso(second)
+        _UTC_ISO_CACHE["second"] = second
+    return _UTC_ISO_CACHE["iso"]
+
+def is_admin_key(key: str) -> bool:
+    # مقارنة بزمن ثابت حتى لا يُستنتج التوكن من زمن الرد
+    return secrets.compare_digest(key.encode(), ADMIN_TOKEN_BYTES)
 
 def hash_code(code: str):
-    return hashlib.sha256(code.encode()).hexdigest()
+    return hashlib.blake2b(code.encode(), key=CODE_HASH_KEY, digest_size=16).hexdigest()
+
+def issue_codes(count: int, expires_ts: float, duration: str) -> List[str]:
+    """توليد وحفظ count كوداً؛ الكود الذي يصادف كوداً محفوظاً يُستبدل بآخر جديد"""
+    codes: List[str] = []
+    while len(codes) < count:
+        batch = {hash_code(code): code for code in generate_short_codes(count - len(codes))}
+        taken = set(save_codes(list(batch), expires_ts, duration))
+        codes.extend(code for code_hash, code in batch.items() if code_hash not in taken)
+    return codes
 
-def create_jwt(expires_at: datetime):
+# /activate: إعادة إرسال نفس الكود لا تعيد حساب الهاش
+# (/generate-code يستدعي hash_code مباشرة حتى لا تملأ الأكواد الجديدة الكاش)
+cached_hash_code = lru_cache(maxsize=1024)(hash_code)
+
+# مسار HS256 مباشر: المفتاح والترويسة محسوبان مرة واحدة
+JWT_KEY = JWT_SECRET.encode()
+# حالة HMAC بعد إدخال المفتاح تُنسخ لكل توقيع بدل إعادة تهيئة المفتاح
+JWT_HMAC = hmac.new(JWT_KEY, digestmod=hashlib.sha256)
+
+def jwt_signature(signing_input: bytes) -> bytes:
+    mac = JWT_HMAC.copy()
+    mac.update(signing_input)
+    return mac.digest()
+
+def b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def b64url_decode(data: bytes) -> bytes:
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+# نفس الترويسة التي يولدها PyJWT، فالتوكنات القديمة تمر بالمسار السريع أيضاً
+JWT_HEADER_B64 = b64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+
+def create_jwt(expires_ts: float):
     payload = {
         "type": "activation",
-        "exp": expires_at
+        "exp": int(expires_ts)
     }
-    return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
+    signing_input = JWT_HEADER_B64 + b"." + b64url_encode(orjson.dumps(payload))
+    signature = jwt_signature(signing_input)
+    return (signing_input + b"." + b64url_encode(signature)).decode()
+
+def decode_jwt(token: str) -> dict:
+    """فك توكن HS256 بترويستنا مباشرة؛ أي ترويسة أخرى تذهب إلى PyJWT"""
+    signing_input, _, signature = token.encode().rpartition(b".")
+    header, _, body = signing_input.partition(b".")
+    if header != JWT_HEADER_B64:
+        return jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+
+    expected = jwt_signature(signing_input)
+    try:
+        valid = hmac.compare_digest(expected, b64url_decode(signature))
+        payload = orjson.loads(b64url_decode(body)) if valid else None
+    except (ValueError, orjson.JSONDecodeError):
+        raise jwt.InvalidTokenError("Malformed token")
+    if not valid or not isinstance(payload, dict):
+        raise jwt.InvalidTokenError("Invalid token")
+
+    exp = payload.get("exp")
+    if exp is not None:
+        if not isinstance(exp, (int, float)):
+            raise jwt.InvalidTokenError("Invalid exp claim")
+        if exp <= time.time():
+            raise jwt.ExpiredSignatureError("Signature has expired")
+    return payload
+
+# digest التوكن -> payload بعد التحقق منه (LRU لتجنب HS256 لكل طلب بنفس التوكن)
+VERIFIED_JWTS = LRUCache(maxsize=10_000)
 
 def verify_jwt(token: str):
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = VERIFIED_JWTS.get(cache_key)
+    if payload is not None:
+        if payload["exp"] > time.time():
+            return payload
+        VERIFIED_JWTS.pop(cache_key)
+        raise HTTPException(status_code=401, detail="TOKEN_EXPIRED")
+
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        return payload
+        payload = decode_jwt(token)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="TOKEN_EXPIRED")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="INVALID_TOKEN")
 
+    # لا نخزن إلا التوكنات ذات exp حتى لا يعيش الكاش أطول من التوكن
+    if "exp" in payload:
+        VERIFIED_JWTS.put(cache_key, payload)
+    return payload
+
 # =====================================================
 # DURATIONS
 # =====================================================
@@ -414,21 +916,19 @@ DURATIONS = {
     "150d": timedelta(days=150),
 }
 
+# المدد بالثواني محسوبة مرة واحدة عند التحميل
+DURATION_SECONDS = {name: delta.total_seconds() for name, delta in DURATIONS.items()}
+
 # =====================================================
 # البرومت المتخصص للتقارير التعليمية
 # =====================================================
-def generate_educational_prompt(report_type: str, subject: str = "", lesson: str = "", 
-                               grade: str = "", target: str = "", place: str = "", count: str = "") -> str:
-    return f"""أنت خبير تربوي تعليمي محترف تمتلك خبرة ميدانية واسعة في التعليم العام.  
+# أجزاء البرومت الثابتة تُجهَّز مرة واحدة؛ لكل طلب تُضاف سطور البيانات فقط بـ join
+REPORT_PROMPT_PREFIX = """أنت خبير تربوي تعليمي محترف تمتلك خبرة ميدانية واسعة في التعليم العام.  
 اعتمد منظورًا تربويًا مهنيًا احترافيًا يركّز على تحسين جودة التعليم، ودعم المعلم، وتعزيز بيئة التعلّم، وخدمة القيادة المدرسية.  
 
-التقرير المطلوب: "{report_type}"
-{subject if subject else ''}
-{lesson if lesson else ''}
-{grade if grade else ''}
-{target if target else ''}
-{place if place else ''}
-{count if count else ''}
+"""
+
+REPORT_PROMPT_SUFFIX = """
 
 **توجيهات مهنية:**
 - كن موضوعيًا ومتزنًا وبنّاءً  
@@ -461,162 +961,227 @@ def generate_educational_prompt(report_type: str, subject: str = "", lesson: str
 
 يرجى تقديم الإجابة باللغة العربية الفصحى، وتنظيمها بحيث يكون كل حقل في سطر منفصل يبدأ برقمه فقط دون ذكر العنوان."""
 
+# الطلبات المتكررة (إعادة المحاولة، الضغط المزدوج) تعيد نفس البرومت من الذاكرة
+@lru_cache(maxsize=1024)
+def generate_educational_prompt(report_type: str, subject: str = "", lesson: str = "", 
+                               grade: str = "", target: str = "", place: str = "", count: str = "") -> str:
+    # الحقول الاختيارية قد تصل null من JSON فتُعامل كنص فارغ
+    return "\n".join((
+        REPORT_PROMPT_PREFIX + f'التقرير المطلوب: "{report_type}"',
+        subject or "", lesson or "", grade or "", target or "", place or "", count or "",
+    )) + REPORT_PROMPT_SUFFIX
+
 # =====================================================
 # دالة الإثراء الذكي
 # =====================================================
-def enrich_and_enforce(text: str, min_words=25, max_words=35, report_type: str = "") -> str:
-    """
-    إثراء النص وتطبيق الحد الأدنى والأقصى للكلمات بشكل ذكي
-    """
-    words = text.split()
-    
-    if len(words) == 0:
-        return text
-    
-    # تحليل السياق من نوع التقرير
-    context_keywords = {
-        "تقرير علاجي": ["العلاج", "الدعم", "تحسين", "تقدم"],
-        "تقرير سلوكي": ["السلوك", "تحفيز", "تعزيز", "مكافأة"],
-        "تقرير تقييمي": ["تقييم", "قياس", "نتائج", "مؤشرات"],
-        "تقرير نشاط": ["نشاط", "مشاركة", "تفاعل", "تطبيق"],
-    }
-    
-    # تحديد الكلمات الإثرائية المناسبة للسياق
-    enrichment_phrases = []
-    for keyword, phrases in context_keywords.items():
-        if keyword in report_type:
-            enrichment_phrases.extend(phrases)
-    
-    # إذا لم نجد سياق محدد، نستخدم الإثراء العام
-    if not enrichment_phrases:
-        enrichment_phrases = LINGUISTIC_ENRICHMENT
+def finalize_text(text: str) -> str:
+    # تحسين جودة النص النهائي
+    text = text.replace("  ", " ").strip()
     
-    # إثراء النص إذا كان قصيراً
-    if len(words) < min_words:
-        # احتساب عدد الكلمات المطلوبة
-        words_needed = min_words - len(words)
-        
-        # إضافة عبارات إثرائية ذكية
-        if len(words) < 15:  # إذا كان النص قصير جداً
-            # إضافة عبارات تربوية محسنة
-            enhancements = [
-                "بما يعزز من جودة الممارسة التعليمية وينسجم مع أهداف المنهج",
-                "وذلك لتحقيق نواتج التعلم المستهدفة ورفع مستوى التحصيل الدراسي",
-                "بما يدعم التطوير المهني المستدام ويعزز فاعلية العملية التعليمية",
-                "ويسهم في بناء بيئة تعلمية محفزة تدعم الإبداع والتميز",
-                "وذلك تماشياً مع رؤية التعليم الحديثة واستراتيجياته التطويرية",
-                "بما يرتقي بالممارسات الصفية ويعزز الشراكة المجتمعية الفاعلة",
-            ]
-            
-            for enhancement in enhancements[:min(2, words_needed//10)]:
-                if len(words) < min_words:
-                    text += " " + enhancement
-                    words = text.split()
-        
-        # إذا مازال النقص موجوداً
-        while len(words) < min_words:
-            # اختيار عبارة إثرائية مناسبة
-            phrase = random.choice(enrichment_phrases)
-            
-            # التأكد من أن الإضافة تتناسب مع سياق النص
-            if not any(word in text for word in phrase.split()[:3]):
-                text += " " + phrase
-                words = text.split()
+    # إضافة نقطة نهائية إذا لم تكن موجودة
+    if text and text[-1] not in [".", "!", "؟"]:
+        text += "."
     
-    # تقليم النص إذا تجاوز الحد الأقصى
+    return text
+
+# كلمات السياق حسب نوع التقرير
+CONTEXT_KEYWORDS = {
+    "تقرير علاجي": ["العلاج", "الدعم", "تحسين", "تقدم"],
+    "تقرير سلوكي": ["السلوك", "تحفيز", "تعزيز", "مكافأة"],
+    "تقرير تقييمي": ["تقييم", "قياس", "نتائج", "مؤشرات"],
+    "تقرير نشاط": ["نشاط", "مشاركة", "تفاعل", "تطبيق"],
+}
+
+# عبارات تربوية محسنة للنصوص القصيرة جداً
+SHORT_TEXT_ENHANCEMENTS = [
+    "بما يعزز من جودة الممارسة التعليمية وينسجم مع أهداف المنهج",
+    "وذلك لتحقيق نواتج التعلم المستهدفة ورفع مستوى التحصيل الدراسي",
+    "بما يدعم التطوير المهني المستدام ويعزز فاعلية العملية التعليمية",
+    "ويسهم في بناء بيئة تعلمية محفزة تدعم الإبداع والتميز",
+    "وذلك تماشياً مع رؤية التعليم الحديثة واستراتيجياته التطويرية",
+    "بما يرتقي بالممارسات الصفية ويعزز الشراكة المجتمعية الفاعلة",
+]
+
+# كلمات كل عبارة إثرائية مقسمة مسبقاً بدل split() داخل حلقة الإثراء
+PHRASE_WORDS = {
+    phrase: tuple(phrase.split())
+    for phrase in [*LINGUISTIC_ENRICHMENT, *SHORT_TEXT_ENHANCEMENTS,
+                   *(word for words in CONTEXT_KEYWORDS.values() for word in words)]
+}
+
+# أول ثلاث كلمات من كل عبارة: لا تُضاف العبارة إذا سبق وجود إحداها في النص
+PHRASE_HEADS = {phrase: frozenset(words[:3]) for phrase, words in PHRASE_WORDS.items()}
+
+def pick_enrichment_phrase(enrichment_phrases, word_set: set) -> str:
+    fitting = [p for p in enrichment_phrases if word_set.isdisjoint(PHRASE_HEADS[p])]
+    # عبارات السياق قليلة؛ إذا استُنفدت ننتقل للإثراء العام
+    if not fitting and enrichment_phrases is not LINGUISTIC_ENRICHMENT:
+        fitting = [p for p in LINGUISTIC_ENRICHMENT if word_set.isdisjoint(PHRASE_HEADS[p])]
+    # لم تبق عبارة جديدة: نقبل التكرار بدل الدوران بلا نهاية
+    return random.choice(fitting or enrichment_phrases)
+
+def trim_to_max_words(text: str, words: List[str], min_words: int, max_words: int) -> str:
+    """تقليم النص إذا تجاوز الحد الأقصى ثم تحسينه النهائي"""
     if len(words) > max_words:
         # المحاولة لتقليم النص بشكل ذكي
         sentences = text.split('،')
         if len(sentences) > 1:
-            trimmed_text = ""
+            kept_sentences = []
             current_words = 0
             for sentence in sentences:
                 sentence_words = sentence.split()
                 if current_words + len(sentence_words) <= max_words - 5:  # ترك مساحة للختام
-                    if trimmed_text:
-                        trimmed_text += "، " + sentence
-                    else:
-                        trimmed_text = sentence
+                    kept_sentences.append(sentence)
                     current_words += len(sentence_words)
                 else:
                     break
             
             if current_words >= min_words:
-                text = trimmed_text + "، مما يسهم في تحقيق الأهداف التربوية المنشودة."
+                text = "، ".join(kept_sentences) + "، مما يسهم في تحقيق الأهداف التربوية المنشودة."
                 words = text.split()
         
         # إذا مازال الطول زائداً، قص الكلمات الزائدة
         if len(words) > max_words:
             text = " ".join(words[:max_words])
     
-    # تحسين جودة النص النهائي
-    text = text.replace("  ", " ").strip()
+    return finalize_text(text)
+
+@lru_cache(maxsize=256)
+def context_enrichment_phrases(report_type: str):
+    """الكلمات الإثرائية المناسبة لسياق نوع التقرير (تُحسب مرة لكل نوع)"""
+    enrichment_phrases = []
+    for keyword, phrases in CONTEXT_KEYWORDS.items():
+        if keyword in report_type:
+            enrichment_phrases.extend(phrases)
     
-    # إضافة نقطة نهائية إذا لم تكن موجودة
-    if text and text[-1] not in [".", "!", "؟"]:
-        text += "."
+    # إذا لم نجد سياق محدد، نستخدم الإثراء العام
+    if not enrichment_phrases:
+        return LINGUISTIC_ENRICHMENT
+    return tuple(enrichment_phrases)
+
+def enrich_and_enforce(text: str, min_words=25, max_words=35, report_type: str = "") -> str:
+    """
+    إثراء النص وتطبيق الحد الأدنى والأقصى للكلمات بشكل ذكي
+    """
+    words = text.split()
     
-    return text
+    if len(words) == 0:
+        return text
+    
+    # النص ضمن الحدود أصلاً: لا إثراء ولا تقليم
+    if min_words <= len(words) <= max_words:
+        return finalize_text(text)
+    
+    # النص الطويل يُقلم فقط بلا إثراء
+    if len(words) > max_words:
+        return trim_to_max_words(text, words, min_words, max_words)
+    
+    enrichment_phrases = context_enrichment_phrases(report_type)
+    
+    # إثراء النص إذا كان قصيراً
+    # نضيف كلمات العبارة المقسمة مسبقاً بدل إعادة تقسيم النص كاملاً بعد كل إضافة
+    word_count = len(words)
+    # أجزاء النص تُجمع في قائمة وتُدمج مرة واحدة بدل += متكرر
+    parts = [text]
+    
+    # احتساب عدد الكلمات المطلوبة
+    words_needed = min_words - word_count
+    
+    # إضافة عبارات إثرائية ذكية
+    if word_count < 15:  # إذا كان النص قصير جداً
+        # إضافة عبارات تربوية محسنة
+        for enhancement in SHORT_TEXT_ENHANCEMENTS[:min(2, words_needed//10)]:
+            if word_count < min_words:
+                parts.append(enhancement)
+                words.extend(PHRASE_WORDS[enhancement])
+                word_count = len(words)
+    
+    # إذا مازال النقص موجوداً
+    word_set = set(words)
+    while word_count < min_words:
+        # اختيار عبارة إثرائية مناسبة لا تكرر كلمات موجودة في النص
+        phrase = pick_enrichment_phrase(enrichment_phrases, word_set)
+        parts.append(phrase)
+        words.extend(PHRASE_WORDS[phrase])
+        word_set.update(PHRASE_WORDS[phrase])
+        word_count = len(words)
+    
+    text = " ".join(parts)
+    
+    return trim_to_max_words(text, words, min_words, max_words)
 
 # =====================================================
 # ROUTES
 # =====================================================
 
+# جسم الرد ثابت ما عدا الوقت، فنسلسله مرة واحدة ونحقن الوقت فقط
+HEALTH_BODY_PREFIX = b'{"status":"healthy","time":"'
+HEALTH_BODY_SUFFIX = b'","service":' + orjson.dumps("ناصر - أداة إصدار التقارير التعليمية") + b'}'
+
 @app.get("/")
 def health():
-    return {
-        "status": "healthy",
-        "time": datetime.utcnow().isoformat(),
-        "service": "ناصر - أداة إصدار التقارير التعليمية"
-    }
+    return Response(
+        content=HEALTH_BODY_PREFIX + cached_utc_iso().encode() + HEALTH_BODY_SUFFIX,
+        media_type="application/json",
+    )
 
 # -----------------------------------------------------
 # توليد كود (مشرف)
 # -----------------------------------------------------
 @app.get("/generate-code")
-def generate_code(key: str, duration: str):
-    if key != ADMIN_TOKEN:
+def generate_code(key: str, duration: str, count: int = 1):
+    if not is_admin_key(key):
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    if duration not in DURATIONS:
+    seconds = DURATION_SECONDS.get(duration)
+    if seconds is None:
         raise HTTPException(status_code=400, detail="Invalid duration")
 
-    code = generate_short_code()
-    code_hash = hash_code(code)
+    if not 1 <= count <= MAX_CODES_PER_REQUEST:
+        raise HTTPException(status_code=400, detail="Invalid count")
 
-    expires_at = datetime.utcnow() + DURATIONS[duration]
-    VALID_CODES[code_hash] = expires_at
+    now = time.time()
+    expires_ts = now + seconds
+    codes = issue_codes(count, expires_ts, duration)
 
-    return {
-        "activation_code": code,
+    result = {
+        "activation_code": codes[0],
         "duration": duration,
-        "expires_at": expires_at.isoformat() + "Z"
+        "expires_at": utc_iso(expires_ts) + "Z"
     }
+    # إصدار دفعة: كل الأكواد بنفس المدة وتاريخ الانتهاء
+    if count > 1:
+        result["activation_codes"] = codes
+    return result
 
 # -----------------------------------------------------
 # تفعيل كود
 # -----------------------------------------------------
 @app.post("/activate")
 def activate(data: ActivateRequest):
-    code = data.code.strip()
+    code = data.code.translate(CODE_NORMALIZE_TABLE)
     if not code:
         raise HTTPException(status_code=400, detail="CODE_REQUIRED")
 
-    code_hash = hash_code(code)
-    expires_at = VALID_CODES.get(code_hash)
+    # رفض الأكواد غير الصالحة شكلياً قبل حساب الهاش والبحث
+    if not ACTIVATION_CODE_RE.fullmatch(code):
+        raise HTTPException(status_code=403, detail="INVALID_CODE")
+
+    code_hash = cached_hash_code(code)
+    expires_ts = get_code_expiry(code_hash)
 
-    if not expires_at:
+    if not expires_ts:
         raise HTTPException(status_code=403, detail="INVALID_CODE")
 
-    if expires_at < datetime.utcnow():
-        VALID_CODES.pop(code_hash, None)
+    if expires_ts < time.time():
+        delete_code(code_hash)
         raise HTTPException(status_code=403, detail="CODE_EXPIRED")
 
-    token = create_jwt(expires_at)
+    token = create_jwt(expires_ts)
 
     return {
         "token": token,
-        "expires_at": expires_at.isoformat() + "Z"
+        "expires_at": utc_iso(expires_ts) + "Z"
     }
 
 # -----------------------------------------------------
@@ -630,31 +1195,79 @@ def verify(x_token: str = Header(..., alias="X-Token")):
 # -----------------------------------------------------
 # الحصول على أنواع التقارير
 # -----------------------------------------------------
+# قائمة الفئات ثابتة فتُبنى مرة واحدة
+REPORT_CATEGORIES = tuple(REPORTS_BY_CATEGORY)
+
+# ردود القوائم الثابتة تُسلسل مرة واحدة عند التحميل ولا تتغير إلا بنشر جديد
+STATIC_JSON_HEADERS = {"Cache-Control": "public, max-age=3600"}
+
+REPORT_CATEGORIES_BODY = orjson.dumps({
+    "categories": REPORT_CATEGORIES,
+    "reports_by_category": REPORTS_BY_CATEGORY
+})
+
 @app.get("/reports/categories")
 def get_report_categories():
-    return {
-        "categories": list(REPORTS_BY_CATEGORY.keys()),
-        "reports_by_category": REPORTS_BY_CATEGORY
-    }
+    return Response(REPORT_CATEGORIES_BODY, media_type="application/json", headers=STATIC_JSON_HEADERS)
 
 # -----------------------------------------------------
 # البحث في التقارير
 # -----------------------------------------------------
+# توحيد أشكال الألف والياء والتاء المربوطة وحذف التشكيل والتطويل في تمريرة واحدة
+ARABIC_SEARCH_TABLE = str.maketrans(
+    {"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه"},
+)
+ARABIC_SEARCH_TABLE.update(str.maketrans("", "", "\u064b\u064c\u064d\u064e\u064f\u0650\u0651\u0652\u0640"))
+
+def normalize_search_text(text: str) -> str:
+    return text.translate(ARABIC_SEARCH_TABLE).lower()
+
+# أسماء التقارير موحّدة مرة واحدة عند التحميل بدل lower() لكل تقرير في كل طلب
+REPORT_SEARCH_ENTRIES = [
+    (normalize_search_text(report), report, category)
+    for category, reports in REPORTS_BY_CATEGORY.items()
+    for report in reports
+]
+
+# فهرس ثنائيات الأحرف: كل زوج أحرف متتاليين -> أرقام التقارير التي تحتويه
+def build_report_search_bigrams() -> Dict[str, set]:
+    bigrams: Dict[str, set] = {}
+    for i, (normalized, _, _) in enumerate(REPORT_SEARCH_ENTRIES):
+        for j in range(len(normalized) - 1):
+            bigrams.setdefault(normalized[j:j + 2], set()).add(i)
+    return bigrams
+
+REPORT_SEARCH_BIGRAMS = build_report_search_bigrams()
+
+def report_search_candidates(term: str) -> List[int]:
+    """التقارير التي تحتوي كل ثنائيات البحث، بترتيبها الأصلي (التحقق النهائي على المستدعي)"""
+    if len(term) < 2:
+        return list(range(len(REPORT_SEARCH_ENTRIES)))
+    postings = sorted(
+        (REPORT_SEARCH_BIGRAMS.get(term[j:j + 2], set()) for j in range(len(term) - 1)),
+        key=len,
+    )
+    return sorted(set.intersection(*postings))
+
 @app.get("/reports/search")
 def search_reports(query: str):
-    if not query or len(query.strip()) < 2:
+    if not query:
+        return {"results": []}
+    
+    # الطول يُفحص بعد التوحيد: بحث من تشكيل فقط يصبح نصاً فارغاً يطابق كل التقارير
+    search_term = normalize_search_text(query.strip())
+    if len(search_term) < 2:
         return {"results": []}
     
-    search_term = query.strip().lower()
     results = []
     
-    for category, reports in REPORTS_BY_CATEGORY.items():
-        for report in reports:
-            if search_term in report.lower():
-                results.append({
-                    "name": report,
-                    "category": category
-                })
+    for i in report_search_candidates(search_term):
+        normalized, report, category = REPORT_SEARCH_ENTRIES[i]
+        if search_term in normalized:
+            results.append({
+                "name": report,
+                "category": category
+            })
     
     return {"results": results}
 
@@ -674,107 +1287,79 @@ def get_report_texts(report_type: str):
 # -----------------------------------------------------
 # الحصول على إدارات التعليم
 # -----------------------------------------------------
+EDUCATION_ADMINISTRATIONS_BODY = orjson.dumps({
+    "administrations": EDUCATION_ADMINISTRATIONS
+})
+
 @app.get("/education/administrations")
 def get_education_administrations():
-    return {
-        "administrations": EDUCATION_ADMINISTRATIONS
-    }
+    return Response(EDUCATION_ADMINISTRATIONS_BODY, media_type="application/json", headers=STATIC_JSON_HEADERS)
 
 # -----------------------------------------------------
 # الحصول على الأدوات التعليمية
 # -----------------------------------------------------
+EDUCATIONAL_TOOLS_BODY = orjson.dumps({
+    "tools": EDUCATIONAL_TOOLS
+})
+
 @app.get("/education/tools")
 def get_educational_tools():
-    return {
-        "tools": EDUCATIONAL_TOOLS
-    }
+    return Response(EDUCATIONAL_TOOLS_BODY, media_type="application/json", headers=STATIC_JSON_HEADERS)
 
 # -----------------------------------------------------
 # الذكاء الاصطناعي العام (القديم)
 # -----------------------------------------------------
 @app.post("/generate")
-def generate_ai_content(data: AskRequest, x_token: str = Header(..., alias="X-Token")):
+async def generate_ai_content(data: AskRequest, x_token: str = Header(..., alias="X-Token")):
     verify_jwt(x_token)
 
     try:
-        model = pick_gemini_model()
-        response = model.generate_content(data.prompt)
-        return {"answer": response.text}
+        return {"answer": await gemini_generate(data.prompt)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # -----------------------------------------------------
 # تحليل استجابة الذكاء الاصطناعي
 # -----------------------------------------------------
+REPORT_FIELD_KEYS = ("goal", "summary", "steps", "strategies", "strengths", "improve", "recomm")
+
+def default_report_fields(report_type: str = "") -> Dict[str, str]:
+    """النصوص الافتراضية مع الإثراء عند فشل تحليل رد الذكاء الاصطناعي"""
+    fields = dict.fromkeys(REPORT_FIELD_KEYS, "")
+    for key in fields:
+        if key in DEFAULT_REPORT_TEXTS:
+            fields[key] = enrich_and_enforce(
+                random.choice(DEFAULT_REPORT_TEXTS[key]), 
+                25, 35, 
+                report_type
+            )
+    return fields
+
+# digest (نص الرد + نوع التقرير) -> الحقول بعد التحليل والإثراء (LRU)
+PARSED_RESPONSES = LRUCache(maxsize=1024)
+
 def parse_ai_response(response_text: str, report_type: str = "") -> Dict[str, str]:
     """تحليل النص الذي يرجع من الذكاء الاصطناعي إلى حقول مع إثراء ذكي"""
     
-    lines = response_text.split('\n')
-    parsed = {
-        "goal": "",
-        "summary": "",
-        "steps": "",
-        "strategies": "",
-        "strengths": "",
-        "improve": "",
-        "recomm": ""
-    }
+    # نفس الرد لنفس نوع التقرير (إعادة المحاولة أو برومت مكرر) لا يُحلل مرتين
+    cache_key = hashlib.blake2b(
+        f"{report_type}\0{response_text}".encode(), digest_size=16
+    ).digest()
+    cached = PARSED_RESPONSES.get(cache_key)
+    if cached is not None:
+        return dict(cached)
     
-    current_field = None
-    field_content = []
+    parsed = dict.fromkeys(REPORT_FIELD_KEYS, "")
     
-    for line in lines:
-        line = line.strip()
-        
-        # البحث عن بداية حقل جديد
-        if line.startswith('1.') or line.startswith('١.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "goal"
-            field_content = [line[2:].strip()]
-            
-        elif line.startswith('2.') or line.startswith('٢.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "summary"
-            field_content = [line[2:].strip()]
-            
-        elif line.startswith('3.') or line.startswith('٣.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "steps"
-            field_content = [line[2:].strip()]
-            
-        elif line.startswith('4.') or line.startswith('٤.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "strategies"
-            field_content = [line[2:].strip()]
-            
-        elif line.startswith('5.') or line.startswith('٥.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "strengths"
-            field_content = [line[2:].strip()]
-            
-        elif line.startswith('6.') or line.startswith('٦.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "improve"
-            field_content = [line[2:].strip()]
-            
-        elif line.startswith('7.') or line.startswith('٧.'):
-            if current_field and field_content:
-                parsed[current_field] = ' '.join(field_content).strip()
-            current_field = "recomm"
-            field_content = [line[2:].strip()]
-            
-        elif current_field and line and not line.startswith(('1','2','3','4','5','6','7','١','٢','٣','٤','٥','٦','٧')):
-            field_content.append(line)
-    
-    # الحقل الأخير
-    if current_field and field_content:
-        parsed[current_field] = ' '.join(field_content).strip()
+    # الحقل المكرر يحل محل السابق
+    parser = ReportFieldParser()
+    for line in response_text.split('\n'):
+        field = parser.feed(line)
+        if field:
+            parsed[field[0]] = field[1]
+    field = parser.close()
+    if field:
+        parsed[field[0]] = field[1]
     
     # تطبيق الإثراء الذكي على كل حقل
     for key in parsed:
@@ -783,55 +1368,217 @@ def parse_ai_response(response_text: str, report_type: str = "") -> Dict[str, st
     
     # إذا فشل التحليل، نستخدم النصوص الافتراضية مع الإثراء
     if not any(parsed.values()):
-        for key in parsed:
-            if key in DEFAULT_REPORT_TEXTS:
-                parsed[key] = enrich_and_enforce(
-                    random.choice(DEFAULT_REPORT_TEXTS[key]), 
-                    25, 35, 
-                    report_type
-                )
+        parsed = default_report_fields(report_type)
     
+    PARSED_RESPONSES.put(cache_key, dict(parsed))
     return parsed
 
 # -----------------------------------------------------
 # توليد تقرير تعليمي متكامل (الجديد)
 # -----------------------------------------------------
+async def build_educational_report(data: ReportGenerateRequest, read_cache: bool = True, store_cache: bool = True) -> Dict:
+    # إنشاء البرومت المتخصص
+    prompt = generate_educational_prompt(
+        report_type=data.reportType,
+        subject=data.subject,
+        lesson=data.lesson,
+        grade=data.grade,
+        target=data.target,
+        place=data.place,
+        count=data.count
+    )
+    
+    # استخدام الذكاء الاصطناعي
+    ai_text = await gemini_generate_report(prompt, read_cache, store_cache)
+    
+    # تحليل الاستجابة مع الإثراء الذكي
+    parsed_fields = parse_ai_response(ai_text, data.reportType)
+    
+    return {
+        "success": True,
+        "report_type": data.reportType,
+        "parsed_fields": parsed_fields,
+        "raw_response": ai_text
+    }
+
 @app.post("/generate/report")
-def generate_educational_report(data: ReportGenerateRequest, x_token: str = Header(..., alias="X-Token")):
+async def generate_educational_report(data: ReportGenerateRequest, x_token: str = Header(..., alias="X-Token"),
+                                      cache_control: Optional[str] = Header(None, alias="Cache-Control")):
     verify_jwt(x_token)
     
     if not data.reportType:
         raise HTTPException(status_code=400, detail="نوع التقرير مطلوب")
     
     try:
-        # إنشاء البرومت المتخصص
-        prompt = generate_educational_prompt(
-            report_type=data.reportType,
-            subject=data.subject,
-            lesson=data.lesson,
-            grade=data.grade,
-            target=data.target,
-            place=data.place,
-            count=data.count
-        )
+        return await build_educational_report(data, *report_cache_policy(cache_control))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في توليد التقرير: {str(e)}")
+
+# -----------------------------------------------------
+# توليد تقرير في الخلفية (رد فوري برقم مهمة ثم استعلام)
+# -----------------------------------------------------
+# مراجع المهام الجارية حتى لا يجمعها garbage collector قبل انتهائها
+REPORT_JOB_TASKS = set()
+
+# محاولات حفظ نتيجة المهمة (قفل SQLite أو انقطاع Redis مؤقت) قبل الاستسلام
+REPORT_JOB_SAVE_ATTEMPTS = 3
+
+async def store_report_job(job_id: str, job: Dict) -> bool:
+    for attempt in range(REPORT_JOB_SAVE_ATTEMPTS):
+        try:
+            await asyncio.to_thread(save_report_job, job_id, job)
+            return True
+        except Exception:
+            # المهمة تعمل في الخلفية فلا أحد يرى الخطأ إن لم يُسجَّل
+            logger.exception("Failed to store report job %s (attempt %d)", job_id, attempt + 1)
+            if attempt + 1 < REPORT_JOB_SAVE_ATTEMPTS:
+                await asyncio.sleep(0.5 * (attempt + 1))
+    return False
+
+async def run_report_job(job_id: str, data: ReportGenerateRequest, read_cache: bool, store_cache: bool):
+    try:
+        job = {"status": "ready", "result": await build_educational_report(data, read_cache, store_cache)}
+    except asyncio.CancelledError:
+        # إيقاف الخادم أثناء التوليد: سجل فشل بدل بقاء المهمة pending حتى انتهاء صلاحيتها
+        await store_report_job(job_id, {"status": "failed", "detail": "توقف الخادم قبل اكتمال التقرير"})
+        raise
+    except Exception as e:
+        job = {"status": "failed", "detail": f"خطأ في توليد التقرير: {str(e)}"}
+    
+    # تعذر حفظ النتيجة: سجل فشل صغير بدل بقاء المهمة pending حتى انتهاء صلاحيتها
+    if not await store_report_job(job_id, job) and job["status"] == "ready":
+        await store_report_job(job_id, {"status": "failed", "detail": "خطأ في حفظ نتيجة التقرير"})
+
+@app.post("/generate/report/jobs", status_code=202)
+async def enqueue_educational_report(data: ReportGenerateRequest, x_token: str = Header(..., alias="X-Token"),
+                                     cache_control: Optional[str] = Header(None, alias="Cache-Control")):
+    verify_jwt(x_token)
+    
+    if not data.reportType:
+        raise HTTPException(status_code=400, detail="نوع التقرير مطلوب")
+    
+    job_id = secrets.token_urlsafe(16)
+    await asyncio.to_thread(save_report_job, job_id, {"status": "pending"})
+    
+    task = asyncio.create_task(run_report_job(job_id, data, *report_cache_policy(cache_control)))
+    REPORT_JOB_TASKS.add(task)
+    task.add_done_callback(REPORT_JOB_TASKS.discard)
+    
+    return {"task_id": job_id, "status": "pending"}
+
+@app.get("/generate/report/jobs/{job_id}")
+async def get_educational_report_job(job_id: str, x_token: str = Header(..., alias="X-Token")):
+    verify_jwt(x_token)
+    
+    # النتيجة محفوظة في SQLite/Redis فأي عملية uvicorn تستطيع الرد
+    job = await asyncio.to_thread(get_report_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="JOB_NOT_FOUND")
+    
+    return {"task_id": job_id, **job}
+
+# -----------------------------------------------------
+# توليد تقرير تعليمي مع بث النص أثناء توليده
+# -----------------------------------------------------
+@app.post("/generate/report/stream")
+async def stream_educational_report(data: ReportGenerateRequest, x_token: str = Header(..., alias="X-Token")):
+    verify_jwt(x_token)
+    
+    if not data.reportType:
+        raise HTTPException(status_code=400, detail="نوع التقرير مطلوب")
+    
+    prompt = generate_educational_prompt(
+        report_type=data.reportType,
+        subject=data.subject,
+        lesson=data.lesson,
+        grade=data.grade,
+        target=data.target,
+        place=data.place,
+        count=data.count
+    )
+    
+    # فشل Gemini قبل أول بايت يُرجع 500 كما في /generate/report بدل 200 بجسم فارغ
+    try:
+        upstream = await open_gemini_stream(prompt)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في توليد التقرير: {str(e)}")
+    
+    async def body():
+        try:
+            async for text in gemini_stream(upstream):
+                yield text.encode()
+        except Exception as e:
+            # انقطاع البث بعد بدء الرد: سطر خطأ أخير يميز النص المبتور عن المكتمل
+            yield f"\n[ERROR] خطأ في توليد التقرير: {str(e)}\n".encode()
+    
+    # النص الخام يصل للعميل فور توليده؛ التحليل والإثراء يبقيان في /generate/report
+    return StreamingResponse(body(), media_type="text/plain; charset=utf-8")
+
+# -----------------------------------------------------
+# بث حقول التقرير محللة ومثراة حقلاً بحقل (سطر JSON لكل حقل)
+# -----------------------------------------------------
+@app.post("/generate/report/stream/fields")
+async def stream_educational_report_fields(data: ReportGenerateRequest, x_token: str = Header(..., alias="X-Token")):
+    verify_jwt(x_token)
+    
+    if not data.reportType:
+        raise HTTPException(status_code=400, detail="نوع التقرير مطلوب")
+    
+    prompt = generate_educational_prompt(
+        report_type=data.reportType,
+        subject=data.subject,
+        lesson=data.lesson,
+        grade=data.grade,
+        target=data.target,
+        place=data.place,
+        count=data.count
+    )
+    
+    # فشل Gemini قبل أول حقل يُرجع 500 كما في /generate/report
+    try:
+        upstream = await open_gemini_stream(prompt)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"خطأ في توليد التقرير: {str(e)}")
+    
+    def field_line(key: str, text: str) -> bytes:
+        return orjson.dumps({"field": key, "text": text}) + b"\n"
+    
+    async def body():
+        parser = ReportFieldParser()
+        pending = ""
+        sent_any = False
         
-        # استخدام الذكاء الاصطناعي
-        model = pick_gemini_model()
-        response = model.generate_content(prompt)
+        def finished(field):
+            # الحقل المكرر يُرسل مرة أخرى ويعتمد العميل آخر قيمة كما في /generate/report
+            if field and field[1]:
+                return field_line(field[0], enrich_and_enforce(field[1], 25, 30, data.reportType))
+            return None
         
-        # تحليل الاستجابة مع الإثراء الذكي
-        ai_text = response.text
-        parsed_fields = parse_ai_response(ai_text, data.reportType)
+        try:
+            async for text in gemini_stream(upstream):
+                pending += text
+                *lines, pending = pending.split("\n")
+                for line in lines:
+                    out = finished(parser.feed(line))
+                    if out:
+                        sent_any = True
+                        yield out
+        except Exception as e:
+            # انقطاع البث بعد بدء الرد: سطر خطأ أخير يميز الرد المبتور عن المكتمل
+            yield orjson.dumps({"error": f"خطأ في توليد التقرير: {str(e)}"}) + b"\n"
+            return
         
-        return {
-            "success": True,
-            "report_type": data.reportType,
-            "parsed_fields": parsed_fields,
-            "raw_response": ai_text
-        }
+        for field in (parser.feed(pending), parser.close()):
+            out = finished(field)
+            if out:
+                sent_any = True
+                yield out
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"خطأ في توليد التقرير: {str(e)}")
+        if not sent_any:
+            for key, text in default_report_fields(data.reportType).items():
+                yield field_line(key, text)
+    
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
 # -----------------------------------------------------
 # تحويل التاريخ الهجري إلى ميلادي
@@ -853,13 +1600,9 @@ def convert_hijri_date(hijri_date: str):
 # -----------------------------------------------------
 # استشارة تربوية (إضافية)
 # -----------------------------------------------------
-@app.post("/consult/educational")
-def educational_consultation(data: AskRequest, x_token: str = Header(..., alias="X-Token")):
-    """استشارة تربوية مع خبير تعليمي"""
-    verify_jwt(x_token)
-    
-    consult_prompt = f"""أنت مستشار تربوي محترف مع خبرة 20 سنة في المجال التعليمي.
-الاستشارة المطلوبة: {data.prompt}
+# قالب ثابت يُبنى مرة واحدة ويُملأ لكل طلب
+CONSULT_PROMPT_TEMPLATE = """أنت مستشار تربوي محترف مع خبرة 20 سنة في المجال التعليمي.
+الاستشارة المطلوبة: {prompt}
 
 قدم إجابة:
 1. تحليل الموقف
@@ -869,12 +1612,17 @@ def educational_consultation(data: AskRequest, x_token: str = Header(..., alias=
 5. نصائح احترافية
 
 اجعل الإجابة عملية وقابلة للتطبيق في البيئة التعليمية السعودية."""
+
+@app.post("/consult/educational")
+async def educational_consultation(data: AskRequest, x_token: str = Header(..., alias="X-Token")):
+    """استشارة تربوية مع خبير تعليمي"""
+    verify_jwt(x_token)
+    
+    consult_prompt = CONSULT_PROMPT_TEMPLATE.format_map({"prompt": data.prompt})
     
     try:
-        model = pick_gemini_model()
-        response = model.generate_content(consult_prompt)
         return {
-            "consultation": response.text,
+            "consultation": await gemini_generate(consult_prompt),
             "advisor": "خبير تربوي - نظام ناصر التعليمي"
         }
     except Exception as e:
@@ -882,4 +1630,12 @@ def educational_consultation(data: AskRequest, x_token: str = Header(..., alias=
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # عدة عمليات ممكنة لأن الأكواد محفوظة في SQLite/Redis لا في ذاكرة العملية
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )
\ No newline at end of file